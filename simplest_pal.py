@@ -8,18 +8,122 @@ if '.apy' not in importlib.machinery.SOURCE_SUFFIXES:
     importlib.machinery.SOURCE_SUFFIXES.append('.apy')
 
 import sys
-import threading
 import time
 import os
-import io
 import argparse
 import runpy
 import pdb
 import bdb
 import traceback
+import functools
+import re
 
 DEFAULT_LOG_FILE = "pdb_session.log"
 
+# Queued log text is written out early once it grows past this many characters
+_LOG_FLUSH_THRESHOLD = 8192
+
+# Basename of this module, used to recognize PDB stops inside simplest_pal.py itself
+_SELF_BASENAME = sys.intern(os.path.basename(__file__))
+
+# Markers in PDB output that drive the automation in PdbAutomation.readline.
+# Interned, since these literals contain spaces/parens and are not interned automatically.
+_MARK_AI = sys.intern("AI Interaction Point")
+_MARK_CONTEXT = sys.intern("Current Code Context (for AI reference)")
+_MARK_HUMAN = sys.intern("Human Consultation Requested")
+_MARK_PDB = sys.intern("(Pdb)")
+
+# A PDB location line ('> file(line)func()') that points into simplest_pal.py.
+# Leading whitespace is [ \t]* rather than \s*, so a match attempt never runs past
+# its own line; \s* would rescan runs of blank lines and make the search quadratic.
+_INTERNAL_FRAME_RE = re.compile(r"^[ \t]*>[^\n]*" + re.escape(_SELF_BASENAME), re.MULTILINE)
+
+# Bits of the classification key returned by _classify()
+_KEY_AI = 1 << 0       # "AI Interaction Point" seen
+_KEY_CONTEXT = 1 << 1  # "Current Code Context (for AI reference)" seen
+_KEY_HUMAN = 1 << 2    # "Human Consultation Requested" seen
+_KEY_PDB = 1 << 3      # PDB prompt seen
+_KEY_INTERNAL = 1 << 4 # PDB stopped in a simplest_pal.py frame
+
+# Buffers longer than this are classified without caching, so the LRU cache
+# never keeps large chunks of target script output alive
+_CLASSIFY_CACHE_MAX_LEN = 4096
+
+def _scan(buf):
+    """
+    Scans a chunk of buffered PDB output for the markers that drive automation.
+    Returns a 5-bit key built from the _KEY_* flags.
+    """
+    key = 0
+    if _MARK_AI in buf:
+        key |= _KEY_AI
+    if _MARK_CONTEXT in buf:
+        key |= _KEY_CONTEXT
+    if _MARK_HUMAN in buf:
+        key |= _KEY_HUMAN
+    if _MARK_PDB in buf:
+        key |= _KEY_PDB
+        # Check if the current PDB frame points to a file within simplest_pal.py
+        if _INTERNAL_FRAME_RE.search(buf) is not None:
+            key |= _KEY_INTERNAL
+    return key
+
+_scan_cached = functools.lru_cache(maxsize=256)(_scan)
+
+def _classify(buf):
+    """
+    Returns the classification key of a chunk of buffered PDB output.
+    Short buffers are cached, since the same PDB output tends to recur in loops.
+    """
+    if len(buf) > _CLASSIFY_CACHE_MAX_LEN:
+        return _scan(buf)
+    return _scan_cached(buf)
+
+# Automatic responses: (command sent to PDB, message logged and printed)
+_AUTO_CONTINUE = ("c\n", "PDB Automation (readline): Auto-continuing (AI interaction context detected).\n")
+_AUTO_QUIT = ("q\n", "PDB Automation (readline): Auto-quitting as '--pal-quit-on-stop' is enabled.\n")
+_AUTO_UP = ("u\n", "PDB Automation (readline): In internal PDB frame. Auto-sending 'u'.\n") # Move up one frame
+
+def _build_dispatch(quit_on_stop):
+    """
+    Precomputes the automatic response for every classification key.
+    Entries are None where readline() falls through to manual input.
+    """
+    table = []
+    for key in range(1 << 5):
+        if key & _KEY_AI and key & _KEY_CONTEXT:
+            # Automatically continue ('c') if an AI interaction point with context is detected
+            table.append(_AUTO_CONTINUE)
+        elif key & _KEY_PDB and quit_on_stop:
+            # Automatically quit ('q') if the PDB prompt is present and auto-quit-on-stop is enabled
+            table.append(_AUTO_QUIT)
+        elif key & _KEY_INTERNAL:
+            # If PDB is in an internal simplest_pal.py frame, automatically send 'u' to move up
+            table.append(_AUTO_UP)
+        else:
+            table.append(None)
+    return tuple(table)
+
+# Dispatch tables indexed by classification key, selected by quit_on_stop
+_DISPATCH = {False: _build_dispatch(False), True: _build_dispatch(True)}
+
+class _StderrTee:
+    """
+    Lightweight replacement for sys.stderr while PdbAutomation is active.
+    Logs and passes output through to the original stderr without feeding
+    the PDB prompt-detection buffer.
+    """
+    def __init__(self, parent):
+        self._parent = parent
+
+    def write(self, s):
+        self._parent._log_to_file(s)
+        self._parent.original_stderr.write(s)
+        self._parent.original_stderr.flush()
+
+    def flush(self):
+        self._parent.original_stderr.flush()
+
 class PdbAutomation:
     """
     Handles PDB automation by hooking sys.stdin/stdout/stderr.
@@ -33,50 +137,140 @@ class PdbAutomation:
         self.original_stderr = original_stderr
         self.log_file = log_file
         self.quit_on_stop = quit_on_stop
-        self.output_buffer = io.StringIO()
-        self.is_debugging = threading.Event() # Event to indicate if the debugger is currently active
+        self._dispatch = _DISPATCH[bool(quit_on_stop)] # Automatic responses by classification key
+        self._last_buf = None # Single-slot cache of the last classified buffer and its key
+        self._last_key = 0
+        self.output_buffer = [] # Pieces written since the last readline, joined on drain
+        self.is_debugging = False # Flag to indicate if the debugger is currently active (main thread only)
+        self._log_fd = None
+        # Log text waiting to be written; flushed at prompt boundaries by _flush_log()
+        self._log_pending = []
+        self._log_pending_size = 0
+
+        # Write console output straight to the underlying file descriptor when possible.
+        # Skipped where text streams translate newlines (e.g. Windows) or have no real fd.
+        self._stdout_fd = None
+        if os.linesep == '\n':
+            try:
+                self._stdout_fd = original_stdout.fileno()
+                self._stdout_encoding = getattr(original_stdout, 'encoding', None) or 'utf-8'
+                self._stdout_errors = getattr(original_stdout, 'errors', None) or 'strict'
+                original_stdout.flush() # Push out anything already buffered before bypassing it
+            except Exception:
+                self._stdout_fd = None
+
+        # Truncate the log file to start a new session log, and keep it open as a raw
+        # append-only descriptor for the whole session instead of reopening it per write.
+        # Opened before hooking the streams, so a failure here is reported on the real stderr.
+        self._log_fd = os.open(self.log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self._log_to_file(f"--- PDB Session Log Started: {time.ctime()} ---\n")
+        self._flush_log()
 
         sys.stdout = self # Hook standard output for PDB interaction and logging
-        sys.stderr = self # Hook standard error output for PDB interaction and logging
-        
-        # Open the log file in write mode to start a new session log
-        with open(self.log_file, 'w', encoding='utf-8') as f:
-            f.write(f"--- PDB Session Log Started: {time.ctime()} ---\n")
+        sys.stderr = _StderrTee(self) # Hook standard error output for logging only
 
     def _log_to_file(self, s):
         """
-        Appends a string to the dedicated log file.
+        Queues a string for the dedicated log file.
+        The text is written out in one batch by `_flush_log`: at PDB prompt
+        boundaries, once the queue passes `_LOG_FLUSH_THRESHOLD`, or per line
+        while no debugger session is active, so target script output is not
+        held back until the next prompt.
+        Never raises, since it sits on the hooked stdout/stderr write path.
+        Does nothing once the log has been closed, e.g. for writes through a
+        stale reference to the hooked stream after `restore_io`.
         """
+        if self._log_fd is None or not isinstance(s, str):
+            return # Only text is queued, so a bad write cannot break the join in _flush_log()
         try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                f.write(s)
+            self._log_pending.append(s)
+            self._log_pending_size += len(s)
+            if (self._log_pending_size > _LOG_FLUSH_THRESHOLD
+                    or (not self.is_debugging and "\n" in s)):
+                self._flush_log()
+        except Exception:
+            pass
+
+    def _flush_log(self):
+        """
+        Writes all queued log text to the log file in a single call.
+        Never raises, since PDB flushes the hooked stdout after every prompt.
+        """
+        if not self._log_pending:
+            return
+        # Swap out the queue first, so a failed batch is dropped rather than retried forever
+        pending = self._log_pending
+        self._log_pending = []
+        self._log_pending_size = 0
+        if self._log_fd is None:
+            return # Log already closed by close()
+        try:
+            data = "".join(pending).encode('utf-8')
+            while data:
+                data = data[os.write(self._log_fd, data):]
         except Exception as e:
-            # Fallback to original stdout if logging fails
-            self.original_stdout.write(f"PDB Automation: Error writing to log file: {e}\n")
+            # Fallback to the console if logging fails
+            try:
+                self._print_to_console(f"PDB Automation: Error writing to log file: {e}\n")
+            except Exception:
+                pass
 
     def _print_to_console(self, s):
         """
         Writes a string directly to the original standard output (console).
         """
-        self.original_stdout.write(s)
-        self.original_stdout.flush()
+        if self._stdout_fd is None:
+            self.original_stdout.write(s)
+            self.original_stdout.flush()
+            return
+        if not isinstance(s, str):
+            # Match the TypeError the text stream would raise, rather than an AttributeError from encode()
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        data = s.encode(self._stdout_encoding, self._stdout_errors)
+        while data:
+            data = data[os.write(self._stdout_fd, data):]
 
     def write(self, s):
         """
-        Overrides sys.stdout/stderr's write method.
+        Overrides sys.stdout's write method.
         Writes to an internal buffer, the log file, and immediately to the console.
+        Like a text stream, rejects anything but str before it reaches the buffers.
         """
-        self.output_buffer.write(s)
+        if not isinstance(s, str):
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        self.output_buffer.append(s)
         self._log_to_file(s)
         self._print_to_console(s)
 
     def flush(self):
         """
-        Overrides sys.stdout/stderr's flush method.
-        Flushes the original standard output and error streams.
+        Overrides sys.stdout's flush method.
+        Flushes the original standard output and error streams, and the log file.
         """
         self.original_stdout.flush()
         self.original_stderr.flush()
+        self._flush_log()
+
+    def close(self):
+        """
+        Flushes and closes the session log file descriptor.
+        """
+        self._flush_log()
+        if self._log_fd is not None:
+            try:
+                os.close(self._log_fd)
+            except OSError:
+                pass
+            self._log_fd = None
+
+    def _drain_buffer(self):
+        """
+        Returns everything written since the last drain and swaps in a fresh,
+        empty output buffer for the next cycle.
+        """
+        buf = self.output_buffer
+        self.output_buffer = []
+        return "".join(buf)
 
     def readline(self):
         """
@@ -84,52 +278,33 @@ class PdbAutomation:
         (continue, quit, step up), or waits for manual user input.
         """
         # Retrieve all buffered output and clear the buffer for the next cycle
-        current_buffered_output = self.output_buffer.getvalue()
-        self.output_buffer.truncate(0)
-        self.output_buffer.seek(0)
+        current_buffered_output = self._drain_buffer()
 
         # --- PDB Automation Logic ---
-        ai_interaction_point_present = "AI Interaction Point" in current_buffered_output
-        current_code_context_present = "Current Code Context (for AI reference)" in current_buffered_output
-        human_consultation_present = "Human Consultation Requested" in current_buffered_output
-        pdb_prompt_present = '(Pdb)' in current_buffered_output
-
-        # Automatically continue ('c') if an AI interaction point with context is detected
-        if ai_interaction_point_present and current_code_context_present:
-            log_msg = "PDB Automation (readline): Auto-continuing (AI interaction context detected).\n"
-            self._log_to_file(log_msg)
-            self._print_to_console(log_msg)
-            return "c\n"
-
-        # Automatically quit ('q') if the PDB prompt is present and auto-quit-on-stop is enabled
-        if pdb_prompt_present and self.quit_on_stop:
-            log_msg = "PDB Automation (readline): Auto-quitting as '--pal-quit-on-stop' is enabled.\n"
-            self._log_to_file(log_msg)
-            self._print_to_console(log_msg)
-            return "q\n"
-
-        # Logic to automatically move up from internal PDB frames
-        is_in_simplest_pal_frame = False
-        if pdb_prompt_present:
-            # Check if the current PDB frame points to a file within simplest_pal.py
-            for line in current_buffered_output.splitlines():
-                # PDB output typically shows the current line with a '>' prefix
-                if line.strip().startswith('>') and os.path.basename(__file__) in line:
-                    is_in_simplest_pal_frame = True
-                    break
-        
-        # If PDB is in an internal simplest_pal.py frame, automatically send 'u' to move up
-        if is_in_simplest_pal_frame:
-            log_msg = "PDB Automation (readline): In internal PDB frame. Auto-sending 'u'.\n"
+        # Reuse the previous classification when PDB repeats the same output.
+        # Only short buffers are remembered, matching the limit of the _classify cache.
+        if current_buffered_output == self._last_buf:
+            key = self._last_key
+        else:
+            key = _classify(current_buffered_output)
+            if len(current_buffered_output) <= _CLASSIFY_CACHE_MAX_LEN:
+                self._last_buf = current_buffered_output
+                self._last_key = key
+            else:
+                self._last_buf = None
+        action = self._dispatch[key]
+        if action is not None:
+            command, log_msg = action
             self._log_to_file(log_msg)
             self._print_to_console(log_msg)
-            return "u\n" # Move up one frame
+            return command
 
         # --- Manual User Input Logic ---
         # If PDB is displaying a prompt and no automation condition is met, wait for user input
-        if pdb_prompt_present:
+        if key & _KEY_PDB:
             log_msg = "PDB Automation (readline): Waiting for manual user input.\n"
             self._log_to_file(log_msg)
+            self._flush_log()
             # Read command directly from original stdin (blocking read, robust against Ctrl-C)
             user_command = self.original_stdin.readline()
             if not user_command:
@@ -148,7 +323,7 @@ class PdbAutomation:
         Hook called when a PDB debugger session becomes active.
         Sets the internal flag `is_debugging`.
         """
-        self.is_debugging.set()
+        self.is_debugging = True
         self._log_to_file("PDB Automation: Debugger session activated.\n")
         self._print_to_console("PDB Automation: Debugger session activated.\n")
 
@@ -157,17 +332,18 @@ class PdbAutomation:
         Hook called when a PDB debugger session becomes inactive.
         Clears the internal flag `is_debugging`.
         """
-        self.is_debugging.clear()
+        self.is_debugging = False
         self._log_to_file("PDB Automation: Debugger session deactivated.\n")
         self._print_to_console("PDB Automation: Debugger session deactivated.\n")
 
     def restore_io(self):
         """
         Restores the original `sys.stdin`, `sys.stdout`, and `sys.stderr` streams.
-        Also prints a confirmation message about the log file.
+        Closes the log file and prints a confirmation message about the log file.
         """
         sys.stdout = self.original_stdout
         sys.stderr = self.original_stderr
+        self.close()
         self._print_to_console(f"\nPDB session log saved to '{self.log_file}'.\n")
 
 def simplest_pal_main():
@@ -188,6 +364,7 @@ def simplest_pal_main():
 
     # Initialize PDB instance with the custom I/O handler
     pal_debugger = pdb.Pdb(stdin=pdb_auto, stdout=pdb_auto)
+    _pdb_set_trace = pal_debugger.set_trace # Resolve the bound method once for the hook below
 
     def set_trace_with_hooks(frame=None):
         """
@@ -199,7 +376,7 @@ def simplest_pal_main():
         # This is typically the user's code or the point in jrf_pdb_agent_lib.py
         # where pdb.set_trace() was originally called. The PdbAutomation.readline
         # method will handle stepping up if PDB still lands in an internal frame.
-        pal_debugger.set_trace(frame) 
+        _pdb_set_trace(frame) 
         pdb_auto.exit_debugger_hook()
     
     # Override the standard pdb.set_trace with our custom hooked version
@@ -223,11 +400,13 @@ def simplest_pal_main():
     except Exception as e:
         # Catch any other exceptions from the target script
         pdb_auto._print_to_console(f"Simplest P.A.L.: An unhandled exception occurred: {e}\n")
-        # Print full stack trace to the log file and console
-        traceback.print_exc(file=pdb_auto)
+        # Print full stack trace to the log file and console, formatted once
+        tb = traceback.format_exc()
+        pdb_auto._log_to_file(tb)
+        pdb_auto._print_to_console(tb)
     finally:
         # Final cleanup: Ensure debugger is deactivated and restore original I/O
-        if pdb_auto.is_debugging.is_set():
+        if pdb_auto.is_debugging:
             pdb_auto.exit_debugger_hook()
         pdb_auto.restore_io()
 